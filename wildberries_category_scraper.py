@@ -1,11 +1,87 @@
+from dataclasses import dataclass
 from datetime import date
-from os import path, mkdir
+from os import path, mkdir, stat, replace, remove
+from hashlib import sha1
 import logging
-import json
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 import asyncio
 
 import xlsxwriter
-from aiohttp import ClientSession, ServerDisconnectedError, ContentTypeError
+from aiohttp import (ClientSession, TCPConnector, ClientConnectionError,
+                     ClientResponseError)
+from aiohttp_retry import RetryClient, ExponentialRetry
+import zstandard
+
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    _loads = orjson.loads
+except ImportError:
+    import json
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False,
+                          separators=(',', ':')).encode('UTF-8')
+
+    _loads = json.loads
+
+# records go through the root logger, as the log file always had them
+log = logging.getLogger()
+
+def _write_atomic(file_path: str, data: bytes):
+    """
+    Write data to a file through a temporary file and a rename.
+
+    An interrupted write leaves the previous file (or none) in place
+    instead of a truncated one that would look fresh for the rest of the day.
+    """
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'wb') as my_file:
+        my_file.write(data)
+    replace(tmp_path, file_path)
+
+# fixed parts of the filters request url, joined with shard and query
+_FILTERS_URL_HEAD = 'https://catalog.wb.ru/catalog/'
+_FILTERS_URL_PATH = '//v4/filters?appType=1&'
+_FILTERS_URL_TAIL = '&curr=rub&dest=-8144334&spp=30'
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that enqueues records unformatted.
+
+    The stock prepare() formats the message on the calling thread, here
+    formatting is left to the QueueListener thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+class _CrawlAborted(Exception):
+    """Raised in the excel writer thread when the crawl has failed."""
+
+# queue sentinels sent to the excel writer after the last record
+_END = None
+_ABORT = object()
+
+@dataclass(slots=True)
+class CatEntry:
+    """
+    A single category record of the flattened catalogue.
+
+    Categories from the catalogue tree carry url, shard and query,
+    subcategories taken from filters carry the name of their parent instead.
+    """
+    name: str
+    id: int
+    level: int
+    url: str = ''
+    shard: str | int = 99999
+    query: str = ''
+    parent_name: str = ''
 
 class WildBerriesParser:
 
@@ -24,32 +100,122 @@ class WildBerriesParser:
         """
         if (not path.exists("bin")):
             mkdir("bin")
-        logging.basicConfig(level=logging.INFO, filename="bin/py_log.log",filemode="w")
+        # log records are formatted and written on a background thread,
+        # the handler is attached to the root logger only while main runs
+        log_queue = Queue(-1)
+        logging.getLogger().setLevel(logging.INFO)
+        file_handler = logging.FileHandler("bin/py_log.log", mode="w", delay=True)
+        file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        self.log_handler = _DeferredQueueHandler(log_queue)
+        self.log_listener = QueueListener(log_queue, file_handler)
         self.headers = {'Accept': "*/*",
                         'User-Agent': "Mozilla/5.0 Gecko/20100101 Firefox/62.0"}
         self.run_date = date.today()
         self.directory = path.dirname(__file__)
         self.col = 0
         self.level = -1
+        self.session = None
+        self._filter_cache = {}
 
-    async def aio_req(self, url_f, *, headers_f: dict):
+    async def aio_req(self, url_f):
         """
         Wrapping for aiohttp request mechanism 
 
         Aiohttp is a library for async requests, this function
-        mimic requests library format for interface
+        mimic requests library format for interface. All requests go
+        through the shared self.session opened in main, so keep-alive
+        connections are reused instead of handshaking on every call.
 
         Returns:
             json: response from url
+
+        Raises:
+            ClientResponseError: If the response status is 400 or higher.
         """
-        async with ClientSession() as session:
-            async with session.get(url=url_f, headers=headers_f) as response:
-                return_response = await response.json()
+        async with self.session.get(url_f) as response:
+            response.raise_for_status()
+            return_response = await response.json(loads=_loads,
+                                                  content_type=None)
         return return_response
 
-    def download_current_catalogue(self) -> str:
+    async def main(self, tabulation: bool):
+        """
+        Run the whole processing sequence inside a single event loop and session.
+
+        Opens one aiohttp session with a pooled connector for the whole crawl,
+        wrapped in a RetryClient so connection errors, timeouts, rate limits
+        and server errors are retried, downloads the catalogue and processes it. Processed
+        records are passed through a queue to save_to_excel running in a
+        worker thread, so the excel file is written while filters are
+        still being fetched.
+
+        Args:
+            tabulation (bool): Whether to use tabulation in the excel file.
+
+        Returns:
+            None
+        """
+        connector = TCPConnector(limit=100, limit_per_host=32, ttl_dns_cache=300)
+        retry_options = ExponentialRetry(attempts=3, start_timeout=0.3,
+                                         statuses={429, 500, 502, 503, 504},
+                                         exceptions={ClientConnectionError,
+                                                     asyncio.TimeoutError})
+        root_logger = logging.getLogger()
+        root_logger.addHandler(self.log_handler)
+        self.log_listener.start()
+        try:
+            records = Queue()
+            writer = asyncio.get_running_loop().run_in_executor(
+                None, self.save_to_excel, "Result", self._drain(records), tabulation)
+
+            def emit(record):
+                if writer.done():
+                    raise RuntimeError("Excel writer stopped") from writer.exception()
+                records.put(record)
+
+            try:
+                async with RetryClient(client_session=ClientSession(headers=self.headers,
+                                                                    connector=connector),
+                                       retry_options=retry_options,
+                                       raise_for_status=True) as self.session:
+                    local_catalogue_path = await self.download_current_catalogue()
+                    print(f"Каталог сохранен: {local_catalogue_path}")
+                    await self.process_catalogue(local_catalogue_path, emit)
+            except BaseException:
+                # the writer discards the workbook instead of saving a partial one
+                records.put(_ABORT)
+                await asyncio.wait({writer})
+                if not writer.cancelled():
+                    writer.exception()
+                raise
+            records.put(_END)
+            await writer
+        finally:
+            root_logger.removeHandler(self.log_handler)
+            self.log_listener.stop()
+
+    def _drain(self, records: Queue):
         """
-        Download the  catalogue from wildberries.ru and save it in JSON format.
+        Yield records from the queue until the crawl ends.
+
+        Args:
+            records (Queue): Queue filled by the crawl.
+
+        Yields:
+            CatEntry: The next record in catalogue order.
+
+        Raises:
+            _CrawlAborted: If the crawl has failed.
+        """
+        while (record := records.get()) is not _END:
+            if record is _ABORT:
+                raise _CrawlAborted
+            yield record
+
+    async def download_current_catalogue(self) -> str:
+        """
+        Download the  catalogue from wildberries.ru and save it in JSON format
+        compressed with zstandard.
 
         If an up-to-date catalogue already exists in the script's directory,
         it uses that instead.
@@ -57,92 +223,211 @@ class WildBerriesParser:
         Returns:
             str: The path to the downloaded catalogue file.
         """
-        local_catalogue_path = path.join(self.directory, 'bin', 'wb_catalogue.json')
+        local_catalogue_path = path.join(self.directory, 'bin',
+                                         'wb_catalogue.json.zst')
         if (not path.exists(local_catalogue_path)
-                or date.fromtimestamp(int(path.getmtime(local_catalogue_path)))
-                > self.run_date):
+                or date.fromtimestamp(int(stat(local_catalogue_path).st_mtime))
+                < self.run_date):
             url_loc = ('https://static-basket-01.wb.ru/vol0/data/'
                    'main-menu-ru-ru-v2.json')
                    
-            response = asyncio.run(self.aio_req(url_loc, headers_f=self.headers))
-            with open(local_catalogue_path, 'w', encoding='UTF-8') as my_file:
-                json.dump(response, my_file, indent=2, ensure_ascii=False)
+            response = await self.aio_req(url_loc)
+            _write_atomic(local_catalogue_path,
+                          zstandard.ZstdCompressor(level=3).compress(_dumps(response)))
         return local_catalogue_path
     
-    def process_catalogue(self, local_catalogue_path: str) -> list:
+    async def process_catalogue(self, local_catalogue_path: str, emit):
         """
-        Process the locally saved JSON catalogue into a list of dictionaries.
+        Process the locally saved JSON catalogue into CatEntry records.
 
-        This function reads the locally saved JSON catalogue file,
-        invokes the traverse_json method to flatten the catalogue,
-        and returns the resulting catalogue as a list of dictionaries.
+        This function reads and decompresses the locally saved JSON
+        catalogue file and invokes the traverse_json method to flatten the
+        catalogue, passing every resulting CatEntry record to emit.
 
         Args:
             local_catalogue_path (str): The path to the locally saved
               JSON catalogue file.
+            emit (callable): Called with every processed record in
+              catalogue order.
 
         Returns:
-            list: A list of dictionaries representing the processed catalogue.
+            None
         """
-        catalogue = []
-        with open(local_catalogue_path, 'r') as my_file:
-            asyncio.run(self.traverse_json(json.load(my_file), catalogue, -1))
-        return catalogue
+        with open(local_catalogue_path, 'rb') as my_file:
+            tree = _loads(zstandard.ZstdDecompressor().decompress(my_file.read()))
+        await self.traverse_json(tree, emit)
 
-    async def traverse_json(self, parent_category: list, flattened_catalogue: list, level: int):     
+    async def traverse_json(self, parent_category: list, emit):
         """
-        Recursively traverse the JSON catalogue and flatten it to a list.
+        Flatten the JSON catalogue and fetch filters for all leaf categories.
 
-        This function runs recursively through the locally saved JSON
-        catalogue and appends relevant information to the flattened_catalogue
-        list.
-        It handles KeyError exceptions that might occur due to inconsistencies
-        in the keys of the JSON catalogue.
+        This function flattens the catalogue tree with _flatten and groups
+        leaf categories by their (shard, query) pair, so every distinct
+        filter request is made only once. The requests run concurrently
+        (bounded by a semaphore). Records are emitted in the original tree
+        order as soon as they are available, with the resulting
+        subcategories right after every leaf of the group.
 
         Args:
-            parent_category (list): A list containing the current category
+            parent_category (list): A list containing the root categories
               to traverse.
-            flattened_catalogue (list): A list to store the flattened
-              catalogue.
+            emit (callable): Called with every CatEntry record of the
+              flattened catalogue.
 
         Returns:
             None
         """
-        for category in parent_category:
-            level += 1
-            try:
-                flattened_catalogue.append({
-                    'name': category['name'],
-                    'url': category['url'],
-                    'shard': category['shard'] if 'shard' in category else 99999,
-                    'query': category['query'],
-                    'level': level,
-                    'id': category['id']
-                })
-                logging.info(f"name: {category['name']}, url: {category['url']}")
-            except KeyError:
-                level -= 1
+        flattened_catalogue, leaves = self._flatten(parent_category)
+
+        semaphore = asyncio.Semaphore(32)
+        requests = {}
+        leaf_at = {}
+        for position, category, level in leaves:
+            key = (str(category.shard), category.query)
+            if key not in requests:
+                requests[key] = asyncio.ensure_future(
+                    self.bounded_filter_items(semaphore, key))
+            leaf_at[position] = (key, category, level)
+
+        try:
+            for position, record in enumerate(flattened_catalogue):
+                emit(record)
+                if position not in leaf_at:
+                    continue
+                key, category, level = leaf_at[position]
+                nodes = []
+                self.node_json(category, await requests[key], nodes, level)
+                for node in nodes:
+                    emit(node)
+        finally:
+            for request in requests.values():
+                request.cancel()
+
+    def _flatten(self, root: list) -> tuple:
+        """
+        Traverse the JSON catalogue and flatten it to a list.
+
+        This function walks the locally saved JSON catalogue iteratively
+        with an explicit stack and collects relevant information into the
+        flattened catalogue list. Leaf categories are collected into leaves
+        as (position, category, level) records for later filter fetching.
+        Categories missing any of the required keys are skipped together
+        with their children.
+
+        Args:
+            root (list): A list containing the root categories to traverse.
+
+        Returns:
+            tuple: The flattened catalogue list and the list of leaves.
+        """
+        flattened_catalogue = []
+        leaves = []
+        info_enabled = log.isEnabledFor(logging.INFO)
+        stack = [(category, 0) for category in reversed(root)]
+        while stack:
+            category, level = stack.pop()
+            if not ('name' in category and 'url' in category
+                    and 'query' in category and 'id' in category):
                 continue
+            entry = CatEntry(category['name'], category['id'], level,
+                             category['url'], category.get('shard', 99999),
+                             category['query'])
+            flattened_catalogue.append(entry)
+            if info_enabled:
+                log.info("name: %s, url: %s", category['name'], category['url'])
             if 'childs' in category:
-                await self.traverse_json(category['childs'], flattened_catalogue, level)
+                stack.extend((child, level + 1)
+                             for child in reversed(category['childs']))
             # on id=130090 redirects to id=129073, which is still accessable 
             # from original position on catalog tree, so not visiting child nodes
-            if 'childs' not in category and category['id']!=130090:
-                level += 1
-                await self.node_json(category, flattened_catalogue, level)
-                level -= 1
-            level -= 1
+            elif category['id']!=130090:
+                leaves.append((len(flattened_catalogue) - 1, entry, level + 1))
+        return flattened_catalogue, leaves
 
-    async def node_json(self, category: list, flattened_catalogue: list, level: int):
+    async def bounded_filter_items(self, semaphore: asyncio.Semaphore,
+                                   key: tuple) -> list:
         """
-        Get all filter information for category and add needed one using keys
+        Run filter_items for a (shard, query) key while holding the semaphore.
 
-        Download the filter information for category from wildberries.ru and process it 
-        and appends relevant information to the flattened_catalogue list. 
+        Args:
+            semaphore (asyncio.Semaphore): Limits the number of concurrent
+              filter requests.
+            key (tuple): The (shard, query) pair of the category.
+
+        Returns:
+            list: Filter items of the "Категория" filter.
+        """
+        async with semaphore:
+            return await self.filter_items(key)
+
+    async def filter_items(self, key: tuple) -> list:
+        """
+        Get the "Категория" filter items for a (shard, query) key.
+
+        Items are taken from the in-memory or on-disk filter cache when
+        possible, otherwise the filter information is downloaded from
+        wildberries.ru and stored in the cache.
 
         Args:
-            category (list): A list containing the current category
-              to get information about.
+            key (tuple): The (shard, query) pair of the category.
+
+        Returns:
+            list: Filter items of the "Категория" filter.
+        """
+        items = self._filter_cache.get(key)
+        if items is None:
+            items = self.load_filter_cache(key)
+        if items is not None:
+            return items
+
+        shard, query = key
+        try:
+            url_loc = (_FILTERS_URL_HEAD + shard + _FILTERS_URL_PATH + query
+                       + _FILTERS_URL_TAIL)
+            response = await self.aio_req(url_loc)
+        except (ClientConnectionError, asyncio.TimeoutError):
+            log.info("No filters available request")
+            return []
+        except ClientResponseError as error:
+            # error replies are not cached, so a later run can fetch them again
+            log.info("No filters available status %s", error.status)
+            return []
+        except ValueError:
+            log.debug("No filters available json")
+            return []
+        if not response:
+            log.debug("No filters available json")
+            return []
+
+        if not isinstance(response, dict):
+            log.info("No filters available outer")
+            return []
+
+        items = []
+        data = response.get('data')
+        filters = data.get('filters') if isinstance(data, dict) else None
+        first = filters[0] if isinstance(filters, list) and filters else None
+        if isinstance(first, dict) and first.get('name') == "Категория":
+            items = first.get('items')
+            if not isinstance(items, list):
+                items = []
+        else:
+            log.info("No filters available inner")
+        self.save_filter_cache(key, items)
+        return items
+
+    def node_json(self, category: CatEntry, items: list,
+                  flattened_catalogue: list, level: int):
+        """
+        Add subcategories of a category from its filter items
+
+        Process the filter information for category and append relevant
+        information to the flattened_catalogue list. 
+
+        Args:
+            category (CatEntry): The current category to add
+              subcategories for.
+            items (list): Filter items of the "Категория" filter.
             flattened_catalogue (list): A list to store the flattened
               catalogue.
             level (int): Recursion level
@@ -150,81 +435,145 @@ class WildBerriesParser:
         Returns:
             None
         """
-        if (category['name']=="Комбинезоны"):
-            pass
-        try:
-            url_loc = (f"https://catalog.wb.ru/catalog/{category['shard']}/"
-                    f"/v4/filters?appType=1&{category['query']}&curr=rub"
-                    f"&dest=-8144334&spp=30")
-            response = await self.aio_req(url_loc, headers_f=self.headers)
-        except ServerDisconnectedError:
-            logging.info("No filters available request")
-            return
-        except ContentTypeError:
-            logging.info("No filters available json")
-            return
- 
-        try:
-            if (response['data']['filters'][0]['name']=="Категория"):
-                for info in response['data']['filters'][0]['items']:
-                    try:
-                        flattened_catalogue.append({
-                            'parent_name': category['name'],
-                            'name': info['name'],
-                            'level': level,
-                            'id': info['id']
-                        })
-                        logging.info(f"name: {info['name']}, url: {category['name']}")
-                    except:
-                        continue
-            else:
-                logging.info("No filters available inner")
-        except:
-            logging.info("No filters available outer")
-        
-                
-    def save_to_excel(self, file_name: str, catalogue: list, tabulation: bool) -> str:
+        info_enabled = log.isEnabledFor(logging.INFO)
+        for info in items:
+            if (not isinstance(info, dict)
+                    or 'name' not in info or 'id' not in info):
+                continue
+            flattened_catalogue.append(CatEntry(info['name'], info['id'], level,
+                                                parent_name=category.name))
+            if info_enabled:
+                log.info("name: %s, url: %s", info['name'], category.name)
+
+    def filter_cache_path(self, key: tuple) -> str:
+        """
+        Get the path of the on-disk filter cache file for a (shard, query) key.
+
+        Args:
+            key (tuple): The (shard, query) pair of the category.
+
+        Returns:
+            str: The path to the cache file.
+        """
+        digest = sha1('/'.join(key).encode('UTF-8')).hexdigest()
+        return path.join(self.directory, 'bin', 'filters', f"{digest}.json")
+
+    def load_filter_cache(self, key: tuple):
+        """
+        Load filter items for a (shard, query) key from the on-disk cache.
+
+        The cache file is only used if it was written today, the same way
+        download_current_catalogue treats the saved catalogue.
+
+        Args:
+            key (tuple): The (shard, query) pair of the category.
+
+        Returns:
+            list: Cached filter items, or None if there is no fresh cache.
+        """
+        cache_path = self.filter_cache_path(key)
+        if (not path.exists(cache_path)
+                or date.fromtimestamp(int(stat(cache_path).st_mtime))
+                < self.run_date):
+            return None
+        with open(cache_path, 'rb') as my_file:
+            items = _loads(my_file.read())
+        self._filter_cache[key] = items
+        return items
+
+    def save_filter_cache(self, key: tuple, items: list):
+        """
+        Store filter items for a (shard, query) key in memory and on disk.
+
+        Args:
+            key (tuple): The (shard, query) pair of the category.
+            items (list): Filter items from the response.
+
+        Returns:
+            None
+        """
+        self._filter_cache[key] = items
+        cache_path = self.filter_cache_path(key)
+        if (not path.exists(path.dirname(cache_path))):
+            mkdir(path.dirname(cache_path))
+        _write_atomic(cache_path, _dumps(items))
+
+    def save_to_excel(self, file_name: str, catalogue, tabulation: bool) -> str:
         """
         Save the parsed data in xlsx format and return its path.
 
-        This function takes the parsed data stored in the processed_catalogue list
+        This function takes the parsed data from the catalogue iterable
         and saves it as an xlsx file with the specified file name and the current run date
-        appended to it. The resulting file path is returned.
+        appended to it. Rows are written as they arrive, so the catalogue
+        may be consumed while it is still being produced.
+        The workbook is written to a temporary file that replaces the result
+        only after the whole catalogue is consumed, so a failure leaves any
+        earlier result untouched. The resulting file path is returned.
 
         Args:
             file_name (str): The desired file name for the saved xlsx file.
+            catalogue (iterable): CatEntry records in catalogue order.
+            tabulation (bool): Whether to indent records by their level.
 
         Returns:
             str: The path of the saved xlsx file.
         """
         col = 0
-        row = 0
         result_path = (f"{path.join(self.directory, file_name)}_"
                        f"{self.run_date.strftime('%Y-%m-%d')}.xlsx")
-        workbook = xlsxwriter.Workbook(result_path)
-
-        for record in catalogue:           
-            
-            if (tabulation):
-                tab_level = col + 3*record['level']
-            else:
-                tab_level = col
-
-            if (record['level'] == 0):
-                if ('worksheet' in locals()):
-                    worksheet.autofit()
-                worksheet = workbook.add_worksheet(record['name'])
-                row = 0
-
-            worksheet.write(row, tab_level, record['level'])
-            worksheet.write(row, tab_level + 1, record['id'])
-            worksheet.write(row, tab_level + 2, record['name'])
-            
-            row += 1
-
-        worksheet.autofit()
+        tmp_path = f"{result_path}.tmp"
+        workbook = xlsxwriter.Workbook(tmp_path, {'constant_memory': True,
+                                                  'strings_to_numbers': False})
+
+        # column offsets by level, grown as deeper levels arrive since the
+        # maximum level is not known while the catalogue is streamed
+        tabs = []
+        try:
+            # constant_memory mode does not support autofit, so column widths
+            # are tracked while writing and set once a worksheet is finished
+            worksheet = None
+            for record in catalogue:
+                level = record.level
+                if (level == 0):
+                    if (worksheet):
+                        self._set_column_widths(worksheet, widths)
+                    worksheet = workbook.add_worksheet(record.name)
+                    _w = worksheet.write_row
+                    widths = {}
+                    row = 0
+                if (level >= len(tabs)):
+                    tabs.extend(col + 3*tab if tabulation else col
+                                for tab in range(len(tabs), level + 1))
+                tab_level = tabs[level]
+                values = (level, record.id, record.name)
+                _w(row, tab_level, values)
+                row += 1
+                for column, value in enumerate(values, tab_level):
+                    widths[column] = max(widths.get(column, 0), len(str(value)))
+
+            if (worksheet):
+                self._set_column_widths(worksheet, widths)
+        except BaseException:
+            workbook.close()
+            remove(tmp_path)
+            raise
         workbook.close()
+        replace(tmp_path, result_path)
         return result_path
+
+    def _set_column_widths(self, worksheet, widths: dict):
+        """
+        Set column widths of a finished worksheet.
+
+        Args:
+            worksheet (xlsxwriter.Worksheet): The worksheet to update.
+            widths (dict): Column widths by column index.
+
+        Returns:
+            None
+        """
+        for column, width in widths.items():
+            worksheet.set_column(column, column, width)
     
     def run_parser(self, tabulation: bool):
         """
@@ -243,10 +592,7 @@ class WildBerriesParser:
         Returns:
             None
         """
-        local_catalogue_path = self.download_current_catalogue()
-        print(f"Каталог сохранен: {local_catalogue_path}")
-        processed_catalogue = self.process_catalogue(local_catalogue_path)
-        self.save_to_excel("Result", processed_catalogue, tabulation)
+        asyncio.run(self.main(tabulation))
 
 if __name__ == '__main__':
     app = WildBerriesParser()